@@ -1,23 +1,52 @@
-import ast
 import argparse
-from os import name
+import asyncio
+import hashlib
+import httpx
+import json
+import os
+import re
+from collections import defaultdict
+from contextlib import aclosing
+from functools import lru_cache, partial
+from itertools import islice
 from pathlib import Path
 from fastapi import FastAPI
+from fastapi.routing import APIRoute
 from importlib import import_module
-from langchain.prompts import PromptTemplate
+from langchain.prompts import ChatPromptTemplate
 # from langchain_community.llms import Ollama
-from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain_core.runnables import RunnableSequence
-from langchain_ollama import OllamaLLM
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import RunnableLambda
+from langchain_ollama import ChatOllama
+from pydantic import BaseModel, TypeAdapter
 # Configuration
-OLLAMA_MODEL = "mistral"
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "mistral:7b-instruct-v0.3-q4_K_M")
+# Upper bound on in-flight LLM requests; match the server's OLLAMA_NUM_PARALLEL
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+# Endpoints packed into one prompt; capped since latency grows with larger batches
+MAX_BATCH_SIZE = 8
+BATCH_SIZE = max(1, min(int(os.getenv("BATCH_SIZE", "6")), MAX_BATCH_SIZE))
+# Token budgets: keep the KV-cache sized to the batch prompt plus the tests it returns
+NUM_PREDICT_PER_TEST = 512
+NUM_PREDICT = NUM_PREDICT_PER_TEST * BATCH_SIZE
+NUM_CTX = 2048 + NUM_PREDICT
+# Keep the model resident between calls instead of reloading it per endpoint batch
+OLLAMA_KEEP_ALIVE = "30m"
 TEST_OUTPUT_DIR = "tests"
 TEST_FILE_NAME = "test_endpoints.py"
+CACHE_FILE = ".llm_cache.json"
+# Bump whenever the template in create_prompt_template changes so cached tests are regenerated
+PROMPT_VERSION = b"6"
 
-def get_fastapi_app(app_path:str, app_name:str) -> FastAPI:
+def _mod_path(p: str) -> str:
+    """Convert a file-style app path (e.g. 'app/main.py') into a dotted module path"""
+    return p.replace("/", ".").replace("\\", ".").removesuffix(".py")
+
+def get_fastapi_app(mod_path:str, app_name:str) -> FastAPI:
     """Import the FastAPI app from the specified module"""
     try:
-        module= import_module(app_path.replace("/",".").replace("\\",".").rstrip(".py"))
+        module= import_module(mod_path)
         app = getattr(module,app_name, None)
         if not isinstance(app,FastAPI):
             raise ValueError(f"{app_name} is not FastAPI instance")
@@ -25,38 +54,36 @@ def get_fastapi_app(app_path:str, app_name:str) -> FastAPI:
     except Exception as e:
         raise Exception(f"Failed to load FastAPI instance")
 
+def _field_schema(field) -> str | None:
+    """JSON schema of a route's body or response field, so changes to the model itself are visible"""
+    if field is None:
+        return None
+    try:
+        return json.dumps(TypeAdapter(field.field_info.annotation).json_schema(), sort_keys=True)
+    except Exception:
+        return str(field.field_info.annotation)
+
 def get_endpoint_details(app: FastAPI):
     """Extract the endpoint details from the FastAPI app"""
-    endpoints =[]
-    for route in app.routes:
-        if hasattr(route, "methods") and hasattr(route, "path") :
-            endpoints.append({
-                "path": route.path,
-                "method": route.methods,
-                "name":route.name,
-                "response_model": str(getattr(route,"response_model",None)),
-                "body_field": str(getattr(route, "body_field", None))
-            })
-    return endpoints
+    return [
+        {
+            "path": route.path,
+            "method": route.methods,
+            "name": route.name,
+            "response_model": str(route.response_model),
+            "body_field": str(route.body_field),
+            "response_schema": _field_schema(route.response_field),
+            "body_schema": _field_schema(route.body_field)
+        }
+        for route in app.routes
+        if isinstance(route, APIRoute)
+    ]
 
-def create_prompt_template():
-    """ Create a Langachain prompt template for test case generation"""    
-    response_schemas = [
-        ResponseSchema(name="test_code", description="Generated pytest test case code ", type="string")
-    ]    
-    output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-    format_instructions = output_parser.get_format_instructions()
-    prompt_template = PromptTemplate(
-        input_variables=["path","method","name","response_model","body_field"],
-        template="""
-        Generate a pytest unit test case for a FastAPI endpoint with the following details:
-        - Path: {path}
-        - Method: {method}
-        - Name: {name}
-        - Response Model: {response_model}
-        - Request Body (optional if present): {body_field}
-
-        The test should: 
+# Static rubric sent as the system message so Ollama can reuse its KV-cache prefix across calls
+SYSTEM_TEMPLATE = """
+        You generate pytest unit test cases for FastAPI endpoints.
+
+        Each test should: 
         - Use `pytest` and `httpx.AsyncClient` for async HTTP requests
         - Include `@pytest.mark.asyncio` for async tests.
         - tests for: 
@@ -67,8 +94,8 @@ def create_prompt_template():
         - Be properly formatted and concise
         - The code should look like it is written by a principal software engineer with 20 years of experience
 
-        Return the response in the follwing format:
-        {{output_parser.get_format_instructions()}}  
+        Return one test case per numbered endpoint, in the same order, as a JSON object:
+        {{"tests": ["<test code for endpoint 1>", "<test code for endpoint 2>", ...]}}
 
         Example test case:
         ```python 
@@ -79,47 +106,231 @@ def create_prompt_template():
             assert response.status_code == 200
             assert response.json() == {{expected_response}}
         ```  
-        """,
-        partial_variables={"output_parser.get_format_instructions()": format_instructions}
-    )
+        """
+USER_TEMPLATE = """
+        Generate a pytest unit test case for each of the following FastAPI endpoints:
+
+        {endpoints_block}
+        """
+
+class TestCases(BaseModel):
+    """Shape of the JSON object returned by the LLM for a batch of endpoints"""
+    tests: list[str]
+
+@lru_cache(maxsize=1)
+def create_prompt_template():
+    """ Create a Langachain prompt template for test case generation, compiled once per process"""    
+    output_parser = JsonOutputParser(pydantic_object=TestCases)
+    prompt_template = ChatPromptTemplate.from_messages([
+        ("system", SYSTEM_TEMPLATE),
+        ("user", USER_TEMPLATE),
+    ])
     return prompt_template, output_parser
 
-def generated_test_case(endpoint: dict, llm,prompt_template :PromptTemplate,output_parser:StructuredOutputParser ):
-    """Generate testcase using Langchain and Local LLM"""
-    chain = RunnableSequence(prompt_template | llm | output_parser)
+def format_endpoints_block(endpoints_chunk: list[dict]) -> str:
+    """Render a chunk of endpoints as numbered sections for the batch prompt"""
+    # Sections follow the 8-space indent of {endpoints_block} in USER_TEMPLATE, details nested under them
+    return "\n\n        ".join(
+        f"[{i}] Path: {e['path']}\n"
+        f"            Method: {','.join(e['method'])}\n"
+        f"            Name: {e['name']}\n"
+        f"            Response Model: {e['response_model']}\n"
+        f"            Request Body (optional if present): {e['body_field']}"
+        for i, e in enumerate(endpoints_chunk, 1)
+    )
+
+def chunked(items: list, size: int = BATCH_SIZE):
+    """Yield successive chunks of at most `size` items"""
+    it = iter(items)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+def split_test_cases(endpoints_chunk: list[dict], result) -> list[str]:
+    """Map a batch LLM result, or the exception it raised, back onto its endpoints"""
+    if isinstance(result, Exception):
+        return [f"# Error generating test case for {endpoint['path']}: {str(result)}" for endpoint in endpoints_chunk]
+    # JsonOutputParser does not enforce TestCases, so the parsed JSON may be any shape
+    tests = result.get("tests") if isinstance(result, dict) else None
+    if not isinstance(tests, list):
+        tests = []
+    return [
+        tests[i] if i < len(tests) and isinstance(tests[i], str) else f"# Error: No test code generated for {endpoint['path']}"
+        for i, endpoint in enumerate(endpoints_chunk)
+    ]
+
+
+def group_by_signature(endpoints: list[dict]) -> dict[int, list[int]]:
+    """Map the index of the first endpoint of each (method, response schema, body schema) group to the indices of the rest
+
+    Endpoints without a response model or request body, or with path parameters, share
+    too little to reuse a test, so each of them is kept in a group of its own.
+    """
+    groups = defaultdict(list)
+    for i, endpoint in enumerate(endpoints):
+        has_schema = endpoint["response_schema"] is not None or endpoint["body_schema"] is not None
+        if has_schema and "{" not in endpoint["path"]:
+            signature = (frozenset(endpoint["method"]), endpoint["response_schema"], endpoint["body_schema"])
+        else:
+            signature = i
+        groups[signature].append(i)
+    return {members[0]: members[1:] for members in groups.values()}
+
+def dedupe_by_key(indices: list[int], keys: list[str]) -> dict[int, list[int]]:
+    """Map the first of `indices` for each cache key to the later ones sharing it, e.g. a router included twice"""
+    groups = defaultdict(list)
+    for i in indices:
+        groups[keys[i]].append(i)
+    return {members[0]: members[1:] for members in groups.values()}
+
+def rewrite_test_case(test_code: str, source: dict, target: dict) -> str | None:
+    """Adapt a test generated for `source` to `target`, or return None if its path literal or test name is not found
+
+    A copy whose test function keeps the source's name would shadow the original in the module.
+    """
+    test_code, matched = re.subn(
+        rf"""(['"]){re.escape(source["path"])}\1""",
+        lambda m: f"{m[1]}{target['path']}{m[1]}",
+        test_code,
+    )
+    if not matched:
+        return None
+    test_code, renamed = re.subn(
+        rf"(def test_\w*?){re.escape(source['name'])}(?![A-Za-z0-9])",
+        lambda m: f"{m[1]}{target['name']}",
+        test_code,
+    )
+    return test_code if renamed else None
+
+def fill_group(slots: list, endpoints: list[dict], followers: dict[int, list[int]], lead: int, test_code: str) -> list[int]:
+    """Place the test for `lead` and the ones derived from it; return the followers it could not be adapted to"""
+    slots[lead] = test_code
+    unmatched = []
+    for i in followers[lead]:
+        rewritten = rewrite_test_case(test_code, endpoints[lead], endpoints[i])
+        if rewritten is None:
+            unmatched.append(i)
+        else:
+            slots[i] = rewritten
+    return unmatched
+
+def flush_ready(f, slots: list, written: int) -> int:
+    """Write the longest run of finished test cases from `written` onwards and release them"""
+    ready = []
+    while written < len(slots) and slots[written] is not None:
+        ready.append(slots[written] + "\n\n")
+        slots[written] = None
+        written += 1
+    f.writelines(ready)
+    return written
+
+def closes_json(buffer: str) -> bool:
+    """Check whether `buffer` already holds a complete JSON document"""
     try:
-        result = chain.invoke({
-            "path":endpoint["path"],
-            "method":",".join(endpoint["method"]),
-            "name": endpoint["name"],
-            "response_model": endpoint["response_model"],
-            "body_field": endpoint["body_field"]
-        })
-        return result.get("test_code",f"# Error: No test code generated for {endpoint['path']}")
-    except Exception as e:
-        return f"# Error generating test case for {endpoint['path']}: {str(e)}"
+        json.loads(buffer)
+    except json.JSONDecodeError:
+        return False
+    return True
 
+async def generated_test_case_streaming(prompt: PromptValue, llm: ChatOllama) -> str:
+    """Stream the completion and stop as soon as the model has emitted a complete JSON object"""
+    buffer = ""
+    async with aclosing(llm.astream(prompt)) as stream:
+        async for chunk in stream:
+            token = chunk.content
+            buffer += token
+            if "}" in token and closes_json(buffer):
+                break
+    return buffer
 
-def generate_test(app_path: str,app_name:str,out_dir: str= TEST_OUTPUT_DIR):
-    """Generate UTs for endpoints in the fastAPI"""
-    llm = OllamaLLM(model="mistral")
+def load_cache(cache_file: str = CACHE_FILE) -> dict:
+    """Load previously generated test cases keyed by endpoint signature"""
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_cache(cache: dict, cache_file: str = CACHE_FILE):
+    """Persist generated test cases for reuse on the next run"""
+    with open(cache_file, "w") as f:
+        json.dump(cache, f)
+
+def cache_key(endpoint: dict) -> str:
+    """Content-addressed key over the endpoint signature, model and prompt version"""
+    signature = json.dumps(endpoint, sort_keys=True, default=sorted).encode()
+    return hashlib.blake2b(signature + OLLAMA_MODEL.encode() + PROMPT_VERSION).hexdigest()
+
+async def generate_test_async(app_path: str,app_name:str,out_dir: str= TEST_OUTPUT_DIR):
+    """Generate UTs for endpoints in the fastAPI, querying the LLM concurrently"""
+    llm = ChatOllama(
+        model=OLLAMA_MODEL,
+        num_ctx=NUM_CTX,
+        num_predict=NUM_PREDICT,
+        num_thread=os.cpu_count(),
+        keep_alive=OLLAMA_KEEP_ALIVE,
+        format="json",
+        client_kwargs={"limits": httpx.Limits(max_connections=OLLAMA_NUM_PARALLEL, max_keepalive_connections=OLLAMA_NUM_PARALLEL)},
+    )
     prompt_template, out_parser = create_prompt_template()
+    chain = prompt_template | RunnableLambda(partial(generated_test_case_streaming, llm=llm)) | out_parser
     Path(out_dir).mkdir(exist_ok=True)
     output_file = Path(out_dir) / TEST_FILE_NAME
-    app = get_fastapi_app(app_path,app_name)
+    mod_path = _mod_path(app_path)
+    app = get_fastapi_app(mod_path,app_name)
     endpoints = get_endpoint_details(app)
+    cache = load_cache()
+    keys = [cache_key(endpoint) for endpoint in endpoints]
+    # Only the first endpoint of each signature group is sent to the LLM; the rest are derived from it
+    followers = group_by_signature(endpoints)
+    slots = [None] * len(endpoints)
+    # Cached tests are available up front; misses are filled in as their batch completes
+    unmatched = []
+    for lead in followers:
+        if keys[lead] in cache:
+            unmatched += fill_group(slots, endpoints, followers, lead, cache[keys[lead]])
+    pending = [lead for lead in followers if keys[lead] not in cache]
     with open(output_file, "w") as f:
-        f.write("from fastapi.testclient import TestClient\n")
-        f.write("import pytest\n")
-        f.write("import httpx\n\n")
-        f.write(f"from {app_path.replace('/', '.').rstrip('.py')} import {app_name}\n\n")
-        f.write("client = TestClient(app)\n\n")
+        f.write("".join([
+            "from fastapi.testclient import TestClient\n",
+            "import pytest\n",
+            "import httpx\n\n",
+            f"from {mod_path} import {app_name}\n\n",
+            "client = TestClient(app)\n\n",
+        ]))
+        written = flush_ready(f, slots, 0)
 
-        for endpoint in endpoints:
-            test_code = generated_test_case(endpoint, llm, prompt_template, out_parser)
-            f.write(test_code + "\n\n")
+        while pending or unmatched:
+            # Followers whose copied test could not be adapted get generated on their own
+            for i in unmatched:
+                followers[i] = []
+                if keys[i] in cache:
+                    slots[i] = cache[keys[i]]
+                else:
+                    pending.append(i)
+            unmatched = []
+            written = flush_ready(f, slots, written)
+            same_key = dedupe_by_key(pending, keys)
+            chunks = list(chunked(list(same_key)))
+            pending = []
+            async for idx, result in chain.abatch_as_completed(
+                [{"endpoints_block": format_endpoints_block([endpoints[i] for i in chunk])} for chunk in chunks],
+                config={"max_concurrency": OLLAMA_NUM_PARALLEL},
+                return_exceptions=True,
+            ):
+                chunk = chunks[idx]
+                for i, test_code in zip(chunk, split_test_cases([endpoints[i] for i in chunk], result)):
+                    if not test_code.startswith("# Error"):
+                        cache[keys[i]] = test_code
+                    for j in [i, *same_key[i]]:
+                        unmatched += fill_group(slots, endpoints, followers, j, test_code)
+                written = flush_ready(f, slots, written)
 
         print(f"Tests written to {output_file}")
+    save_cache(cache)
+
+def generate_test(app_path: str,app_name:str,out_dir: str= TEST_OUTPUT_DIR):
+    """Generate UTs for endpoints in the fastAPI"""
+    asyncio.run(generate_test_async(app_path, app_name, out_dir))
 
 def main():
     """Main function to run the agent."""
@@ -0,0 +1,122 @@
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+from main import cache_key, dedupe_by_key, get_endpoint_details, group_by_signature, rewrite_test_case, split_test_cases
+
+
+def endpoint(path, name, method="GET", response_schema='{"title": "Item"}', body_schema=None):
+    return {
+        "path": path,
+        "method": {method},
+        "name": name,
+        "response_model": str(response_schema),
+        "body_field": str(body_schema),
+        "response_schema": response_schema,
+        "body_schema": body_schema,
+    }
+
+
+def test_group_by_signature_groups_matching_schemas():
+    endpoints = [
+        endpoint("/items", "list_items"),
+        endpoint("/products", "list_products"),
+        endpoint("/items", "create_item", method="POST", body_schema='{"title": "ItemCreate"}'),
+    ]
+    assert group_by_signature(endpoints) == {0: [1], 2: []}
+
+
+def test_group_by_signature_keeps_schemaless_endpoints_apart():
+    endpoints = [
+        endpoint("/", "root", response_schema=None),
+        endpoint("/health", "health", response_schema=None),
+    ]
+    assert group_by_signature(endpoints) == {0: [], 1: []}
+
+
+def test_group_by_signature_separates_body_models_with_same_parameter_name():
+    class UserCreate(BaseModel):
+        name: str
+
+    class OrderCreate(BaseModel):
+        quantity: int
+
+    app = FastAPI()
+
+    @app.post("/users")
+    def create_user(payload: UserCreate):
+        return payload
+
+    @app.post("/orders")
+    def create_order(payload: OrderCreate):
+        return payload
+
+    assert group_by_signature(get_endpoint_details(app)) == {0: [], 1: []}
+
+
+def test_group_by_signature_keeps_parametrized_paths_apart():
+    endpoints = [
+        endpoint("/items/{item_id}", "read_item"),
+        endpoint("/products/{product_id}", "read_product"),
+    ]
+    assert group_by_signature(endpoints) == {0: [], 1: []}
+
+
+def test_dedupe_by_key_maps_repeated_keys_to_first_index():
+    keys = ["a", "b", "a", "c", "b"]
+    assert dedupe_by_key([0, 1, 2, 4], keys) == {0: [2], 1: [4]}
+
+
+def test_rewrite_test_case_substitutes_path_and_test_name():
+    test_code = (
+        "def test_status_ok():\n"
+        '    response = client.get("/status")\n'
+        "    assert response.status_code == 200\n"
+        "    assert response.json() == {}\n"
+    )
+    rewritten = rewrite_test_case(test_code, endpoint("/status", "status"), endpoint("/health", "health"))
+    assert rewritten == (
+        "def test_health_ok():\n"
+        '    response = client.get("/health")\n'
+        "    assert response.status_code == 200\n"
+        "    assert response.json() == {}\n"
+    )
+
+
+def test_rewrite_test_case_returns_none_without_path_literal():
+    test_code = 'def test_read_item():\n    response = client.get("/items/1")\n'
+    source = endpoint("/items/{item_id}", "read_item")
+    target = endpoint("/products/{product_id}", "read_product")
+    assert rewrite_test_case(test_code, source, target) is None
+
+
+def test_rewrite_test_case_returns_none_without_endpoint_name_in_test():
+    test_code = 'def test_returns_200():\n    response = client.get("/items")\n'
+    assert rewrite_test_case(test_code, endpoint("/items", "list_items"), endpoint("/products", "list_products")) is None
+
+
+def test_cache_key_changes_with_body_model():
+    class UserV1(BaseModel):
+        name: str
+
+    class UserV2(BaseModel):
+        name: str
+        email: str
+
+    keys = []
+    for model in (UserV1, UserV2):
+        app = FastAPI()
+
+        @app.post("/users")
+        def create_user(payload: model):
+            return payload
+
+        keys.append(cache_key(get_endpoint_details(app)[0]))
+    assert keys[0] != keys[1]
+
+
+def test_split_test_cases_falls_back_on_non_object_json():
+    chunk = [endpoint("/items", "list_items"), endpoint("/products", "list_products")]
+    assert split_test_cases(chunk, ["def test_a(): ..."]) == [
+        "# Error: No test code generated for /items",
+        "# Error: No test code generated for /products",
+    ]